@@ -1,7 +1,43 @@
 import numpy as np
 from gym import spaces
+from gym.utils import seeding
+from gym.vector import VectorEnv
 
 from ge_world import mujoco_env
+from ge_world.mujoco_env import unorm
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
+
+
+def _action_table(actions, id_less=False, dtype=np.float64):
+    """
+    All 2D combinations of `actions`, as an (n_actions, 2) array. Ordered as
+    `[(a, b) for a in actions for b in actions]`.
+
+    :param actions: the discrete values along each axis
+    :param id_less: drop the all-zero (identity) action
+    :param dtype:
+    :return: (n_actions, 2) ndarray
+    """
+    actions = np.asarray(actions, dtype=dtype)
+    table = np.stack(np.meshgrid(actions, actions, indexing='ij'), -1).reshape(-1, 2)
+    if id_less:
+        table = table[np.any(table != 0, axis=1)]
+    return np.ascontiguousarray(table)
+
+
+def _damped_gains(gear, mass, damping, T):
+    """
+    Closed-form response of a damped slide joint, `m v' = gear * a - c v`, that starts at rest
+    and is driven by a constant control `a` for time `T`.
+
+    :return: (dx, v), the displacement and the final velocity per unit of control.
+    """
+    decay = 1 - np.exp(-damping * T / mass)
+    return gear / damping * (T - mass / damping * decay), gear / damping * decay
 
 
 class Controls:
@@ -25,11 +61,8 @@ class Controls:
 
     @property
     def _goals(self):
-        while True:
-            # chances decrease exponentially. Better to generate by pair.
-            goals = self.rng.uniform(low=5, high=1, size=(self.k, 2))
-            if (np.linalg.norm(goals, axis=-1) < 10).all():
-                return goals
+        # all goals in [1, 5)^2 lie within the radius-10 disk, so no rejection is needed.
+        return self.rng.uniform(low=1.0, high=5.0, size=(self.k, 2))
 
     def __repr__(self):
         return f"Reacher Control: index({self.index}) true goal({self.true_goal}) all goals({self.goals})"
@@ -47,7 +80,7 @@ class Controls:
 
     def sample_task(self, index=None):
         if index is None:
-            self.index = np.random.randint(0, self.k)
+            self.index = self.rng.randint(0, self.k)
         else:
             self.index = index
             assert index < self.k, f"index need to be less than the number of tasks {self.k}."
@@ -59,26 +92,27 @@ class PointMassEnv(mujoco_env.MujocoEnv):
     2D Point Mass Environment. Uses torque control.
     """
 
-    def __init__(self, frame_skip=10, discrete=False, id_less=False, done_on_goal=False):
+    def __init__(self, frame_skip=10, discrete=False, id_less=False, done_on_goal=False, analytic=False):
         """
 
         :param frame_skip:
         :param discrete:
         :param id_less:
         :param done_on_goal: False, bool. flag for setting done to True when reaching the goal
+        :param analytic: False, bool. flag for integrating the point mass in closed form instead of
+            running the MuJoCo solver. The slide joints are linear damped systems, so the displacement
+            from rest is exact up to the solver error. The joint limits and the arena border are
+            simplified to a hard clip at +/- 0.3. These are the dynamics of `BatchPointMassEnv`.
         """
         self.controls = Controls(k_goals=1)
         self.discrete = discrete
         self.done_on_goal = done_on_goal
+        self.analytic = analytic
         if self.discrete:
             set_spaces = False
-            actions = [-.5, 0, .5]
-            if id_less:
-                self.a_dict = [(a, b) for a in actions for b in actions if not (a == 0 and b == 0)]
-                self.action_space = spaces.Discrete(8)
-            else:
-                self.a_dict = [(a, b) for a in actions for b in actions]
-                self.action_space = spaces.Discrete(9)
+            # lookup table for the discrete actions, indexed once per step.
+            self.a_dict = _action_table([-.5, 0, .5], id_less=id_less)
+            self.action_space = spaces.Discrete(len(self.a_dict))
         else:
             set_spaces = True
 
@@ -86,8 +120,14 @@ class PointMassEnv(mujoco_env.MujocoEnv):
         import os
         xml_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), f"assets/point-mass.xml")
 
-        mujoco_env.MujocoEnv.__init__(self, xml_path, frame_skip=frame_skip, set_spaces=set_spaces)
+        mujoco_env.MujocoEnv.__init__(self, xml_path, frame_skip=frame_skip, set_action_space=set_spaces,
+                                      set_observation_space=False)
         # utils.EzPickle.__init__(self)
+        # displacement and velocity per unit of control after one env step, for `analytic`.
+        self._dx_gain, self._v_gain = _damped_gains(
+            gear=self.model.actuator_gear[:2, 0],
+            mass=self.model.dof_armature[:2] + self.model.body_mass[self.model.body_name2id("object")],
+            damping=self.model.dof_damping[:2], T=self.dt)
 
         # note: Experimental, hard-coded
         self.observation_space = spaces.Box(low=np.array([-0.3, -0.3]),
@@ -99,24 +139,41 @@ class PointMassEnv(mujoco_env.MujocoEnv):
     def k(self):
         return self.controls.k
 
+    def seed(self, seed=None):
+        # seed the task sampler together with the env, so that `sample_task` is reproducible.
+        self.controls.seed(seed)
+        return super().seed(seed)
+
     def get_reward(self, state, goal):
-        return 0. if np.linalg.norm(state - goal) < 0.02 else -1.
+        d = state - goal
+        return 0. if (d @ d) < 0.0004 else -1.  # 0.02 ** 2
 
     def get_goal(self):
         return self.controls.goals  # plural bc this used to be multitask
 
     reach_counts = 0
 
+    def _integrate(self, a):
+        """closed-form step: the velocity is zeroed on each step, so the displacement is linear in `a`."""
+        data = self.sim.data
+        a = np.clip(a, -1., 1.)  # the actuator ctrlrange
+        # note: a hard clip, in place of the soft joint limit and the arena border.
+        data.qpos[:2] = np.clip(data.qpos[:2] + self._dx_gain * a, -0.3, 0.3)
+        data.qvel[:2] = self._v_gain * a
+        data.time += self.dt
+        # single kinematics pass, for rendering.
+        self.sim.forward()
+
     def step(self, a):
-        qpos = self.sim.data.qpos
-        qvel = self.sim.data.qvel
-        qvel[:2] = 0
-        self.set_state(qpos, qvel)
         if self.discrete:
             a = self.a_dict[int(a)]
-        vec = self._get_delta()
-        dist = np.linalg.norm(vec)
-        self.do_simulation(a, self.frame_skip)
+        dist = unorm(self._get_delta())
+        if self.analytic:
+            self._integrate(a)
+        else:
+            # zero the velocity in-place. `do_simulation` picks up the edit.
+            self.sim.data.qvel[:2] = 0
+            self.do_simulation(a, self.frame_skip)
         # note: return observation *after* simulation. This is how DeepMind Lab does it.
         ob = self._get_obs()
         reward = self.get_reward(ob, self.controls.goals)
@@ -152,7 +209,7 @@ class PointMassEnv(mujoco_env.MujocoEnv):
         self.reach_counts = 0
         qpos = self.np_random.uniform(low=-0.1, high=0.1, size=self.model.nq) + self.init_qpos
         # this sets the target body position.
-        goals = np.random.uniform(-0.3, 0.3, 2)
+        goals = self.np_random.uniform(-0.3, 0.3, 2)
         if self.fix_goal:
             goals = np.array([0., 0.])
         self.controls.sample_goal(goals)
@@ -175,8 +232,10 @@ class PointMassEnv(mujoco_env.MujocoEnv):
         return img
 
     def _get_delta(self):
-        *delta, _ = self.get_body_com("goal") - self.get_body_com("object")
-        return delta
+        # both bodies sit at the same offset, and only move along their slide joints. So the
+        # delta is read from qpos directly, which is current without a forward pass.
+        qpos = self.sim.data.qpos
+        return qpos[2:4] - qpos[:2]
 
     def _get_obs(self):
         x = self.sim.data.qpos.flat[:2]
@@ -196,6 +255,127 @@ class PointMassEnv(mujoco_env.MujocoEnv):
         return self.controls.true_goal
 
 
+def _step_kernel(pos, vel, goal, a, dx_gain, v_gain, thresh2, dist, reward, done):
+    """fused integrate + reward kernel of `BatchPointMassEnv`. Writes into the arrays in-place."""
+    for i in prange(pos.shape[0]):
+        vel[i, 0] = v_gain * a[i, 0]
+        vel[i, 1] = v_gain * a[i, 1]
+        pos[i, 0] = min(max(pos[i, 0] + dx_gain * a[i, 0], -0.3), 0.3)
+        pos[i, 1] = min(max(pos[i, 1] + dx_gain * a[i, 1], -0.3), 0.3)
+        dx = pos[i, 0] - goal[i, 0]
+        dy = pos[i, 1] - goal[i, 1]
+        d2 = dx * dx + dy * dy
+        dist[i] = d2 ** 0.5
+        reward[i] = 0.0 if d2 < thresh2 else -1.0
+        done[i] = d2 < thresh2
+
+
+if njit is not None:
+    _step_kernel = njit(parallel=True, fastmath=True, cache=True)(_step_kernel)
+
+
+class BatchPointMassEnv(VectorEnv):
+    """
+    Vectorized 2D Point Mass Environment, without MuJoCo.
+
+    Holds `n_envs` point masses as (n, 2) arrays and integrates them analytically in
+    numpy. Implements the gym VectorEnv interface (`step_async`/`step_wait`). Finished
+    environments are reset automatically, the returned observation is the first
+    observation of the new episode.
+    """
+    # these match `assets/point-mass.xml`
+    timestep = 0.01
+    gear = 10.
+    mass = 1.  # the joint armature. The body mass is negligible.
+    damping = 0.1
+
+    def __init__(self, n_envs=64, frame_skip=10, discrete=False, id_less=False, seed=None, use_numba=True):
+        """
+
+        :param n_envs: number of parallel point masses
+        :param frame_skip:
+        :param discrete:
+        :param id_less:
+        :param seed:
+        :param use_numba: True, bool. run the numba kernel when numba is installed. Otherwise use numpy.
+        """
+        self.use_numba = use_numba and njit is not None
+        self.frame_skip = frame_skip
+        self.discrete = discrete
+        if self.discrete:
+            self.a_lut = _action_table([-.5, 0, .5], id_less=id_less, dtype=np.float32)
+            action_space = spaces.Discrete(len(self.a_lut))
+        else:
+            action_space = spaces.Box(low=-1., high=1., shape=(2,), dtype=np.float32)
+        observation_space = spaces.Box(low=-0.3, high=0.3, shape=(2,), dtype=np.float32)
+        # sets the batched spaces, and `single_observation_space`/`single_action_space`.
+        super().__init__(n_envs, observation_space, action_space)
+
+        self.pos = np.zeros((n_envs, 2), dtype=np.float32)
+        self.vel = np.zeros((n_envs, 2), dtype=np.float32)
+        self.goal = np.zeros((n_envs, 2), dtype=np.float32)
+        self._actions = None
+        # same closed-form response as `PointMassEnv(analytic=True)`.
+        self._dx_gain, self._v_gain = _damped_gains(self.gear, self.mass, self.damping, self.dt)
+        self.seed(seed)
+
+    @property
+    def dt(self):
+        return self.timestep * self.frame_skip
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def _reset_idx(self, idx, n):
+        self.pos[idx] = self.np_random.uniform(low=-0.1, high=0.1, size=(n, 2))
+        self.vel[idx] = 0
+        self.goal[idx] = self.np_random.uniform(-0.3, 0.3, size=(n, 2))
+
+    def reset_wait(self):
+        self._reset_idx(slice(None), self.num_envs)
+        return self.pos.copy()
+
+    def step_async(self, actions):
+        self._actions = actions
+
+    def step_wait(self):
+        a = self._actions
+        if self.discrete:
+            a = self.a_lut[np.asarray(a, dtype=np.int64)]
+        else:
+            a = np.clip(a, -1., 1.)
+        # broadcast a single action to all envs, so that both paths see an (n, 2) array.
+        a = np.ascontiguousarray(np.broadcast_to(a, self.pos.shape), dtype=np.float32)
+        # the single env zeros the velocity before each step, so the displacement is linear in `a`.
+        # note: the joint limits and the arena border are simplified to a hard clip at +/- 0.3.
+        if self.use_numba:
+            # the outputs are returned to the caller, so they are allocated fresh on each step.
+            n = self.num_envs
+            dist = np.empty(n, dtype=np.float32)
+            reward = np.empty(n, dtype=np.float32)
+            done = np.empty(n, dtype=np.bool_)
+            _step_kernel(self.pos, self.vel, self.goal, a, self._dx_gain, self._v_gain, 0.02 ** 2,
+                         dist, reward, done)
+        else:
+            self.vel[:] = self._v_gain * a
+            self.pos += self._dx_gain * a
+            np.clip(self.pos, -0.3, 0.3, out=self.pos)
+
+            dist = np.linalg.norm(self.pos - self.goal, axis=1)
+            reward = np.where(dist < 0.02, 0., -1.).astype(np.float32)
+            done = reward == 0
+        # batched info, one entry per env along the first axis.
+        infos = dict(dist=dist, success=done.astype(np.float32))
+
+        if done.any():
+            self._reset_idx(done, np.count_nonzero(done))
+        return self.pos.copy(), reward, done, infos
+
+    def close_extras(self, **kwargs):
+        pass
+
+
 from gym.envs import register
 
 if __name__ == "__main__":
@@ -233,3 +413,8 @@ else:
         max_episode_steps=50,
         reward_threshold=-3.75,
     )
+    register(
+        id="PointMassBatch-v0",
+        entry_point=BatchPointMassEnv,
+        kwargs={'discrete': True},
+    )
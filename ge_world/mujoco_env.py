@@ -16,6 +16,11 @@ except ImportError as e:
 DEFAULT_SIZE = 640, 480
 
 
+def unorm(u):
+    """norm of a small 1-D vector. Faster than `np.linalg.norm`."""
+    return (u @ u) ** 0.5
+
+
 class MujocoEnv(gym.Env):
     """
     This is a simplified version of the gym MujocoEnv class.
@@ -33,6 +38,7 @@ class MujocoEnv(gym.Env):
         if not path.exists(fullpath):
             raise IOError("File %s does not exist" % fullpath)
         self.frame_skip = frame_skip
+        self.fullpath = fullpath
         self.model = mujoco_py.load_model_from_path(fullpath)
         self.sim = mujoco_py.MjSim(self.model)
         self.data = self.sim.data
@@ -83,6 +89,42 @@ class MujocoEnv(gym.Env):
         self.viewer = old_viewer
         return ob
 
+    # model arrays that the envs edit at run time, e.g. `set_color` and the peg slot position.
+    pickled_model_fields = ('geom_rgba', 'body_pos')
+
+    def __getstate__(self):
+        """The MuJoCo handles can not be pickled. Drop them, and keep the sim state and the
+        edited model arrays instead."""
+        state = self.__dict__.copy()
+        for k in ['model', 'sim', 'data', 'viewer', '_viewers']:
+            state.pop(k, None)
+        sim_state = self.sim.get_state()
+        state['_sim_state'] = dict(time=sim_state.time,
+                                   qpos=sim_state.qpos.copy(),
+                                   qvel=sim_state.qvel.copy(),
+                                   act=None if sim_state.act is None else sim_state.act.copy(),
+                                   udd_state=dict(sim_state.udd_state))
+        state['_sim_ctrl'] = self.sim.data.ctrl.copy()
+        state['_model_fields'] = {k: getattr(self.model, k).copy() for k in self.pickled_model_fields}
+        return state
+
+    def __setstate__(self, state):
+        """Reload the model from `fullpath`, then restore the model arrays and the sim state."""
+        sim_state, ctrl = state.pop('_sim_state'), state.pop('_sim_ctrl')
+        model_fields = state.pop('_model_fields')
+        self.__dict__.update(state)
+        self.model = mujoco_py.load_model_from_path(self.fullpath)
+        for k, v in model_fields.items():
+            getattr(self.model, k)[:] = v
+        self.sim = mujoco_py.MjSim(self.model)
+        self.sim.set_constants()
+        self.data = self.sim.data
+        self.viewer = None
+        self._viewers = {}
+        self.sim.set_state(mujoco_py.MjSimState(**sim_state))
+        self.sim.data.ctrl[:] = ctrl
+        self.sim.forward()
+
     def set_state(self, qpos, qvel):
         assert qpos.shape == (self.model.nq,) and qvel.shape == (self.model.nv,)
         old_state = self.sim.get_state()
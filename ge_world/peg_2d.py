@@ -1,3 +1,4 @@
+import math
 from contextlib import ExitStack
 
 import numpy as np
@@ -5,25 +6,27 @@ from gym import spaces
 
 from ge_world import mujoco_env
 from ge_world.base_envs import MazeCamEnv
-from ge_world.mujoco_env import MujocoEnv
+from ge_world.mujoco_env import MujocoEnv, unorm
 
 
 def elbow_pos(angles):
+    """works on a single state, or on a batch of states of shape (n, 3)."""
     l = 0.02
-    x_pos = l * np.cos(angles[0]) + \
-            l * np.cos(angles[:2].sum(axis=-1))
-    y_pos = l * np.sin(angles[0]) + \
-            l * np.sin(angles[:2].sum(axis=-1))
+    x_pos = l * np.cos(angles[..., 0]) + \
+            l * np.cos(angles[..., :2].sum(axis=-1))
+    y_pos = l * np.sin(angles[..., 0]) + \
+            l * np.sin(angles[..., :2].sum(axis=-1))
     return x_pos, y_pos
 
 
 def effector_pos(angles):
+    """works on a single state, or on a batch of states of shape (n, 3)."""
     l = 0.02
-    x_pos = l * np.cos(angles[0]) + \
-            l * np.cos(angles[:2].sum(axis=-1)) + \
+    x_pos = l * np.cos(angles[..., 0]) + \
+            l * np.cos(angles[..., :2].sum(axis=-1)) + \
             l * np.cos(angles.sum(axis=-1))
-    y_pos = l * np.sin(angles[0]) + \
-            l * np.sin(angles[:2].sum(axis=-1)) + \
+    y_pos = l * np.sin(angles[..., 0]) + \
+            l * np.sin(angles[..., :2].sum(axis=-1)) + \
             l * np.sin(angles.sum(axis=-1))
     return x_pos, y_pos
 
@@ -32,30 +35,33 @@ def good_state(state):
     """
     filter for a good goal (state) in the maze.
 
-    :param state:
-    :return: bool, True if goal position is good
+    :param state: a single state, or a batch of states of shape (n, 3)
+    :return: bool, True if goal position is good. Boolean mask for a batch.
     """
     x, y = effector_pos(state)
     x_0, y_0 = elbow_pos(state)
-    return 0.0 < x and -0.0275 < y < 0.0275 and \
-           0.0 < x_0 and -0.0275 < y_0 < 0.0275
+    return (0.0 < x) & (-0.0275 < y) & (y < 0.0275) & \
+           (0.0 < x_0) & (-0.0275 < y_0) & (y_0 < 0.0275)
 
 
 good_goal = good_state
 
+# a 1-dimensional goal is accepted by `good_goal` iff |goal| < GOAL_BOUND.
+GOAL_BOUND = np.arcsin(0.0275 / 0.06)
+
 
 def good_state_slot(state, padding=0):
     """
     filter for a good goal (state) in the maze.
 
-    :param state:
+    :param state: a single state, or a batch of states of shape (n, 3)
     :param padding: default 0, padding to the right.
-    :return: bool, True if goal position is good
+    :return: bool, True if goal position is good. Boolean mask for a batch.
     """
     x, y = effector_pos(state)
     x_0, y_0 = elbow_pos(state)
-    return 0.0 < x < (0.0375 - padding) and -0.0275 < y < 0.0275 and \
-           0.0 < x_0 < (0.0375 - padding) and -0.0275 < y_0 < 0.0275
+    return (0.0 < x) & (x < (0.0375 - padding)) & (-0.0275 < y) & (y < 0.0275) & \
+           (0.0 < x_0) & (x_0 < (0.0375 - padding)) & (-0.0275 < y_0) & (y_0 < 0.0275)
 
 
 class Peg2DEnv(MujocoEnv, MazeCamEnv):
@@ -66,11 +72,19 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
     - Peg2DDiscrete-v0: standard showing the slot on the right
     - Peg2DHiddenDiscrete-v0: makes the slot transparent
     - Peg2DFreeDiscrete-v0: removes the slot for exploration.
+
+    The environment can be pickled, so to run it in subprocesses pass env factories:
+    `AsyncVectorEnv([lambda: gym.make("Peg2D-v0")] * N)`.
     """
     achieved_key = 'x'
     desired_key = 'goal'
-    is_good_goal = lambda self, _: good_goal(_)
-    is_good_state = lambda self, _: good_state(_)
+    goal_img_cache_size = 1024
+
+    def is_good_goal(self, x):
+        return good_goal(x)
+
+    def is_good_state(self, x):
+        return good_state(x)
 
     def __init__(self,
                  frame_skip=4,
@@ -85,6 +99,7 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
                  # hide_slot=False,
                  in_slot=0.1,  # prob. peg to be initialized inside the slot
                  done_on_goal=False,
+                 return_views=False,
                  **kwargs
                  ):
         """
@@ -93,6 +108,9 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         :param discrete:
         :param id_less:
         :param done_on_goal: False, bool. flag for setting done to True when reaching the goal
+        :param return_views: False, bool. when True, `obs['x']` is a view into `sim.data.qpos`, which
+            changes on the next step. Use this only when the caller copies the observation, for example
+            a vectorized wrapper that writes into its batch buffer.
         """
         # self.controls = Controls(k_goals=1)
         self.free = free
@@ -101,12 +119,15 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         self.obs_keys = obs_keys
         self.discrete = discrete
         self.done_on_goal = done_on_goal
+        self.return_views = return_views
 
         self.in_slot = in_slot
 
         if self.discrete:
             actions = [-act_scale, 0, act_scale]
-            self.a_dict = actions
+            self.a_dict = np.asarray(actions, dtype=np.float64)
+            # reused across steps to avoid allocating the control vector.
+            self._act_buf = np.empty(3, dtype=np.float64)
             self.action_space = [spaces.Discrete(3) for _ in range(3)]
 
         # call super init after initializing the variables.
@@ -123,12 +144,12 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         if 'goal' in obs_keys:
             # todo: double check for agreement with actual goal distribution
             _['goal'] = spaces.Box(low=np.array([goal_low, goal_low]), high=np.array([goal_high, goal_high]))
+        # images are returned as uint8, channel first. Normalize downstream.
+        img_shape = (1 if view_mode == "grey" else 3, self.height, self.width)
         if 'img' in obs_keys:
-            _['img'] = spaces.Box(
-                low=np.zeros((1, self.width, self.height)), high=np.ones((1, self.width, self.height)))
+            _['img'] = spaces.Box(low=0, high=255, shape=img_shape, dtype=np.uint8)
         if 'goal_img' in obs_keys:
-            _['goal_img'] = spaces.Box(
-                low=np.zeros((1, self.width, self.height)), high=np.ones((1, self.width, self.height)))
+            _['goal_img'] = spaces.Box(low=0, high=255, shape=img_shape, dtype=np.uint8)
         if 'a' in obs_keys:
             _['a'] = spaces.Box(
                 low=-act_scale * np.ones((3, self.width, self.height)),
@@ -139,20 +160,20 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         self.goal_high = goal_high
         self.view_mode = view_mode
         self.observation_space = spaces.Dict(_)
+        # goal images rendered on reset, keyed by the quantized goal and slot position.
+        self._goal_img_cache = {}
 
     def compute_reward(self, achieved, desired, *_):
         success = np.linalg.norm(achieved - desired, axis=-1, ord=2) < 0.02
         return (success - 1).astype(float)
 
     def step(self, a):
-        qpos = self.sim.data.qpos
-        qvel = self.sim.data.qvel
-        qvel[:] = 0
-        self.set_state(qpos, qvel)
+        # zero the velocity in-place. `do_simulation` picks up the edit.
+        self.sim.data.qvel[:] = 0
 
         # todo: remove discrete action support.
         if self.discrete:
-            a = [self.a_dict[int(a_i)] for a_i in a]
+            a = np.take(self.a_dict, np.asarray(a, dtype=np.intp), out=self._act_buf)
 
         for i in range(self.frame_skip):
             self.do_simulation(a, 1)
@@ -162,7 +183,7 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
             reward = self.compute_reward(ob['x'], ob['goal'])
             done = bool(1 + reward)
             if reward == 0 or i == (self.frame_skip - 1):
-                dist = np.linalg.norm(ob['goal'] - ob['x'], ord=2)
+                dist = unorm(ob['goal'] - ob['x'])
                 return self._get_obs(), reward, done, dict(dist=dist, success=float(done))
 
     def viewer_setup(self):
@@ -182,42 +203,47 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         self.viewer.cam.azimuth = 90
 
     def _get_goal(self):
-        while True:
-            goals = self.np_random.uniform(low=self.goal_low, high=self.goal_high, size=(4, 1))
-            for goal in goals:
-                if good_goal(goal):
-                    return goal
+        # the accepted region of `good_goal` is an interval, so we sample from it directly.
+        goal = self.np_random.uniform(low=max(self.goal_low, -GOAL_BOUND),
+                                      high=min(self.goal_high, GOAL_BOUND), size=(1,))
+        if __debug__:
+            assert good_goal(goal), f"{goal} is not a good goal"
+        return goal
 
     def _get_state(self, slot_y=None):
         if slot_y is not None and self.np_random.rand() < self.in_slot:
             return self._get_goal_state(x=self.np_random.rand() * - 0.01, slot_y=slot_y)
 
+        is_good = good_state if self.free else good_state_slot
         while True:  # keep it simple.
             states = self.np_random.uniform(low=[0, -2.5, 0], high=[1.5, 0, 2.7], size=(20, 3))
-
-            for state in states:
-                if self.free:
-                    if good_state(state):
-                        return state
-                else:
-                    if good_state_slot(state):
-                        return state
+            # filter the entire batch at once, and return the first good state.
+            good, = np.nonzero(is_good(states))
+            if len(good):
+                return states[good[0]]
 
     def _get_goal_state(self, slot_y, x=0., ):
         qpos = np.zeros(3)
 
-        peg_x_y = [x, slot_y / 10]
+        # slot_y can be a size-1 array from `_get_goal`. Use python floats with `math` from here.
+        peg_x_y = [float(x), np.asarray(slot_y).item() / 10]
 
         base = (0.03 + peg_x_y[0])
-        hypo = np.linalg.norm([base, peg_x_y[1]], ord=2)
-        a0 = np.arctan(peg_x_y[1] / base)
-        a1 = np.arccos(hypo / 0.04)
+        hypo = math.hypot(base, peg_x_y[1])
+        a0 = math.atan2(peg_x_y[1], base)
+        a1 = math.acos(hypo / 0.04)
 
         qpos[0] = a0 + a1
         qpos[1] = - 2 * a1
         qpos[2] = 0 - qpos[0] - qpos[1]
         return qpos
 
+    def __getstate__(self):
+        state = MujocoEnv.__getstate__(self)
+        # the cache is rebuilt on demand, no need to pickle or deep-copy the images.
+        state['_goal_img_cache'] = {}
+        return state
+
     def set_slot_pos(self, goal):
         self.model.body_pos[-1, 1] = goal
         self.sim.set_constants()
@@ -262,12 +288,25 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         self.goal_state = goal_pos.copy()
 
         self.set_slot_pos(self.slot_pos)
-        self.set_state(goal_pos, self.sim.data.qvel)
 
-        img = self.mixed_render(self.view_mode, width=self.width, height=self.height)
-        if self.view_mode == "grey":
-            img = img[..., None]
-        self.goal_img = img.transpose(2, 0, 1)
+        # the goal only repeats when the slot is passed in, outside of free mode. Sampled goals are
+        # continuous and never hit, so they are not cached. Mixed mode flashes the slot at random.
+        cacheable = slot_y is not None and not self.free and not self.mix_mode
+        key = np.round(np.append(goal_pos, self.slot_pos) * 1e4).astype(np.int32).tobytes() \
+            if cacheable else None
+        img = self._goal_img_cache.get(key)
+        if img is None:
+            self.set_state(goal_pos, self.sim.data.qvel)
+            img = self.mixed_render(self.view_mode, width=self.width, height=self.height)
+            if self.view_mode == "grey":
+                img = img[..., None]
+            img = img.transpose(2, 0, 1)
+            if key is not None:
+                if len(self._goal_img_cache) >= self.goal_img_cache_size:
+                    # evict the oldest entry
+                    del self._goal_img_cache[next(iter(self._goal_img_cache))]
+                self._goal_img_cache[key] = img
+        self.goal_img = img
 
         # self.set_slot_pos(self.goal)
         self.sim.data.qpos[:] = x
@@ -275,15 +314,14 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         return self._get_obs()
 
     def _get_delta(self):
-        *delta, _ = self.get_body_com("goal") - self.get_body_com("object")
-        return delta
+        return (self.get_body_com("goal") - self.get_body_com("object"))[:2]
 
     def _get_obs(self, *obs_keys):
         obs_keys = obs_keys or self.obs_keys
         obs = {}
-        qpos = self.sim.data.qpos.flat.copy()
+        qpos = self.sim.data.qpos if self.return_views else self.sim.data.qpos.copy()
         if 'x' in obs_keys:
-            obs['x'] = qpos.copy()
+            obs['x'] = qpos
         if 'goal' in obs_keys:
             obs['goal'] = self.goal_state
         if 'ef_pos' in obs_keys:
@@ -291,7 +329,9 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
         if 'img' in obs_keys:
             # if self.hide_slot:
             #     self.set_goal_pos(1)
-            self.set_state(qpos.copy(), self.sim.data.qvel)
+            # the body positions lag qpos by a sub-step after `do_simulation`. One forward pass
+            # brings them up-to-date. Nothing is changed for the render, so there is nothing to restore.
+            self.sim.forward()
 
             img = self.mixed_render(self.view_mode, width=self.width, height=self.height)
             if self.view_mode == "grey":
@@ -299,7 +339,6 @@ class Peg2DEnv(MujocoEnv, MazeCamEnv):
             obs['img'] = img.transpose(2, 0, 1)
             # if self.hide_slot:
             #     self.set_goal_pos(self.goal)
-            self.set_state(qpos, self.sim.data.qvel)
         if 'goal_img' in obs_keys:
             obs['goal_img'] = self.goal_img
 
@@ -93,7 +93,8 @@ class PointMassEnv(mujoco_env.MujocoEnv):
     def step(self, a):
         vec = self._get_delta()
         dist = np.linalg.norm(vec)
-        ctrl = np.square(a).sum()
+        a = np.asarray(a)
+        ctrl = a @ a
         reward = - dist - ctrl
         self.do_simulation(a, self.frame_skip)
         ob = self._get_obs()
@@ -53,3 +53,110 @@ def test_point_mass(setup):
         plt.imshow(image)
         plt.show()
         sleep(0.01)
+
+
+def test_batch_point_mass():
+    import numpy as np
+    from ge_world.amy_point_mass import BatchPointMassEnv
+
+    env = BatchPointMassEnv(n_envs=16, discrete=True, seed=0)
+    obs = env.reset()
+    assert obs.shape == (16, 2)
+    for i in range(10):
+        obs, reward, done, infos = env.step(np.random.randint(0, 9, size=16))
+        assert obs.shape == (16, 2) and reward.shape == (16,) and done.shape == (16,)
+        assert (reward[done] == 0).all() and (reward[~done] == -1).all()
+        assert infos['dist'].shape == (16,) and (infos['success'] == done).all()
+
+
+def test_batch_point_mass_make():
+    import gym
+    from ge_world.amy_point_mass import BatchPointMassEnv
+
+    env = gym.make('PointMassBatch-v0')
+    assert isinstance(env.unwrapped, BatchPointMassEnv)
+    assert env.observation_space.shape == (env.num_envs, 2)
+    assert env.single_observation_space.shape == (2,)
+    assert len(env.action_space.sample()) == env.num_envs
+    obs = env.reset()
+    assert obs.shape == (env.num_envs, 2)
+    obs, reward, done, infos = env.step(env.action_space.sample())
+    assert obs.shape == (env.num_envs, 2) and reward.shape == (env.num_envs,)
+
+
+def test_batch_point_mass_numba():
+    import numpy as np
+    pytest.importorskip('numba')
+    from ge_world.amy_point_mass import BatchPointMassEnv
+
+    env = BatchPointMassEnv(n_envs=16, seed=0, use_numba=True)
+    env_np = BatchPointMassEnv(n_envs=16, seed=0, use_numba=False)
+    assert np.allclose(env.reset(), env_np.reset(), atol=1e-6)
+    rng = np.random.RandomState(0)
+    for i in range(20):
+        # a single (2,) action is broadcast to all envs.
+        act = rng.uniform(-1, 1, size=2 if i % 2 else (16, 2))
+        obs, reward, done, infos = env.step(act)
+        obs_np, reward_np, done_np, infos_np = env_np.step(act)
+        assert np.allclose(obs, obs_np, atol=1e-6)
+        assert (reward == reward_np).all() and (done == done_np).all()
+        assert np.allclose(infos['dist'], infos_np['dist'], atol=1e-6)
+
+
+def test_point_mass_analytic():
+    import numpy as np
+    from ge_world.amy_point_mass import PointMassEnv
+
+    env, env_analytic = PointMassEnv(), PointMassEnv(analytic=True)
+    env.seed(0)
+    env_analytic.seed(0)
+    assert np.allclose(env.reset(), env_analytic.reset())
+    for act in [[0.5, -0.5], [1, 0.2], [-0.3, 0.]]:
+        ob, reward, done, info = env.step(np.array(act))
+        ob_analytic, reward_analytic, done, info_analytic = env_analytic.step(np.array(act))
+        assert np.allclose(ob, ob_analytic, atol=1e-6)
+        assert reward == reward_analytic
+        assert np.isclose(info['dist'], info_analytic['dist'], atol=1e-6)
+
+
+def test_batch_point_mass_matches_single():
+    import numpy as np
+    from ge_world.amy_point_mass import BatchPointMassEnv, PointMassEnv
+
+    env = PointMassEnv(analytic=True)
+    batch_env = BatchPointMassEnv(n_envs=4, frame_skip=env.frame_skip)
+    assert np.allclose(batch_env._dx_gain, env._dx_gain)
+    assert np.allclose(batch_env._v_gain, env._v_gain)
+
+
+def test_peg_2d_filters():
+    import math
+    import numpy as np
+    from ge_world.peg_2d import good_state, good_state_slot, good_goal, GOAL_BOUND
+
+    def positions(s):
+        l = 0.02
+        elbow = l * math.cos(s[0]) + l * math.cos(s[0] + s[1]), \
+                l * math.sin(s[0]) + l * math.sin(s[0] + s[1])
+        effector = elbow[0] + l * math.cos(sum(s)), elbow[1] + l * math.sin(sum(s))
+        return elbow, effector
+
+    def scalar_good_state(s, x_max=math.inf):
+        (x_0, y_0), (x, y) = positions(s)
+        return 0.0 < x < x_max and -0.0275 < y < 0.0275 and \
+               0.0 < x_0 < x_max and -0.0275 < y_0 < 0.0275
+
+    states = np.random.RandomState(0).uniform(low=[0, -2.5, 0], high=[1.5, 0, 2.7], size=(2000, 3))
+    mask = good_state(states)
+    assert mask.shape == (2000,) and mask.any()
+    assert (mask == [scalar_good_state(s) for s in states]).all()
+    for padding in [0, 0.002]:
+        mask = good_state_slot(states, padding=padding)
+        assert mask.any()
+        assert (mask == [scalar_good_state(s, 0.0375 - padding) for s in states]).all()
+    # a single state returns a boolean
+    assert good_state(states[0]) == scalar_good_state(states[0])
+
+    for sign in [1, -1]:
+        assert good_goal(np.array([sign * GOAL_BOUND * (1 - 1e-6)]))
+        assert not good_goal(np.array([sign * GOAL_BOUND * (1 + 1e-6)]))